@@ -1,23 +1,44 @@
 import os
 import io
+import copy
+import base64
 import json
+import re
+import time
+import enum
 import asyncio
 import logging
-import threading
+import secrets
+import functools
+from collections import defaultdict, deque
 from datetime import datetime
-from typing import Dict, Any, List, Optional
-from urllib.parse import urlsplit, urlunsplit
-
+from types import MappingProxyType
+from typing import Dict, Any, BinaryIO, Deque, List, Mapping, Optional, Tuple
+from urllib.parse import unquote_to_bytes, urlencode, urlsplit, urlunsplit
+
+import httpx
+from cachetools import TTLCache
+import orjson
+import openpyxl
+from aiohttp import web
 import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from tenacity import retry, stop_after_attempt, wait_exponential
+from selectolax.lexbor import LexborHTMLParser
+
+try:  # optional: đọc xlsx bằng calamine (Rust) nhanh hơn nhiều, thiếu thì dùng openpyxl
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+from tenacity import retry, retry_if_exception, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
-from telegram import Update
+from telegram import InputMediaPhoto, Update
+from telegram.error import BadRequest, RetryAfter
+from telegram.helpers import escape_markdown
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger("popmart-bot")
+# httpx log full URL mỗi request ở INFO (vd res.php?key=<TWO_CAPTCHA_API_KEY>...) => chỉ giữ WARNING trở lên
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # ===== Config =====
 # BASE_URL có thể là root (vd https://your-app) hoặc đã kèm /popmart (vd https://your-app/popmart)
@@ -29,25 +50,93 @@ BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 ADMINS = [x.strip() for x in os.getenv("ADMINS", "").split(",") if x.strip()]
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
 MAX_WORKERS_CAP = int(os.getenv("MAX_WORKERS", "10"))
+# Pool kết nối HTTP: giữ socket TLS "ấm" giữa các lần gọi Ajax.aspx (mặc định httpx chỉ giữ 5s)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(MAX_WORKERS_CAP * 4)))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+# Cache danh sách phiên theo idNgayBanHang (giây)
+SESSIONS_CACHE_TTL = float(os.getenv("SESSIONS_CACHE_TTL", "60"))
+SESSIONS_CACHE_MAX = int(os.getenv("SESSIONS_CACHE_MAX", "256"))
 
 # 2Captcha (optional)
 TWO_CAPTCHA_API_KEY = os.getenv("TWO_CAPTCHA_API_KEY", "").strip()
 USE_2CAPTCHA = os.getenv("USE_2CAPTCHA", "0").strip() == "1"
 CAPTCHA_SOFT_TIMEOUT = int(os.getenv("CAPTCHA_SOFT_TIMEOUT", "120"))
-CAPTCHA_POLL_INTERVAL = int(os.getenv("CAPTCHA_POLL_INTERVAL", "5"))
+CAPTCHA_POLL_INTERVAL = int(os.getenv("CAPTCHA_POLL_INTERVAL", "5"))  # khoảng poll tối đa (backoff)
+CAPTCHA_FIRST_POLL = float(os.getenv("CAPTCHA_FIRST_POLL", "8"))  # chờ trước lần poll đầu (captcha thường xong sau 10-20s)
 CAPTCHA_MAX_TRIES = int(os.getenv("CAPTCHA_MAX_TRIES", "4"))
+# Số dòng xử lý song song trong 1 ngày (lấy captcha -> giải -> submit). 1 = tuần tự như cũ.
+# Captcha gắn với cookie phiên: >1 thì mỗi dòng chạy song song dùng 1 PopmartClient.fork() (cookie jar riêng),
+# chỉ nên bật khi site cấp captcha theo từng phiên cookie. Chỉ áp dụng khi dùng 2Captcha.
+ROW_CONCURRENCY = max(1, int(os.getenv("ROW_CONCURRENCY", os.getenv("CAPTCHA_PREFETCH", "1"))))
+# Pingback: URL public trỏ tới endpoint /2captcha của bot (để trống => poll res.php như cũ)
+PINGBACK_URL = os.getenv("PINGBACK_URL", "").strip()
+PINGBACK_PORT = int(os.getenv("PINGBACK_PORT", "8081"))
+# Token bí mật gắn vào query pingback (?token=...) và được kiểm tra ở handler: endpoint mở trên 0.0.0.0,
+# không có token thì ai cũng có thể "giải" captcha đang chờ. Để trống => sinh ngẫu nhiên mỗi lần chạy.
+PINGBACK_TOKEN = os.getenv("PINGBACK_TOKEN", "").strip() or secrets.token_urlsafe(24)
+# Pingback không về sau ngần này giây => chuyển captcha sang poll res.php (tránh chờ hết CAPTCHA_SOFT_TIMEOUT)
+PINGBACK_GRACE = float(os.getenv("PINGBACK_GRACE", "30"))
 
 # Cho phép chạy lại cùng ngày ở lần upload sau (mặc định: cho phép)
 DISABLE_GLOBAL_DAY_DEDUP = os.getenv("DISABLE_GLOBAL_DAY_DEDUP", "1").strip() == "1"
 
 # Anti-dup theo phiên đang chạy trong cùng thời điểm
+# (chỉ truy cập từ event loop của bot -> không cần lock)
 ACTIVE_DAYS = set()
-COMPLETED_DAYS = set()
-ACTIVE_LOCK = threading.Lock()
+# Ngày đã chạy xong: tự hết hạn sau COMPLETED_DAYS_TTL giây để bot chạy lâu không giữ mãi
+COMPLETED_DAYS_TTL = int(os.getenv("COMPLETED_DAYS_TTL", "86400"))
+COMPLETED_DAYS: TTLCache = TTLCache(maxsize=10_000, ttl=COMPLETED_DAYS_TTL)
+
+# <img ... src="..."> đầu tiên trong HTML captcha (Action=LoadCaptcha); src có thể là URL hoặc data URI
+_IMG_SRC_RE = re.compile(r'<img[^>]+src=["\']([^"\']+)', re.I)
+
+# Phân loại phản hồi submit (bytes, không decode) trong 1 lượt quét:
+#   nhóm 1 = thành công, nhóm 2 = phiên hết lượt, nhóm 3 = sai captcha
+# re.I trên bytes chỉ gộp hoa/thường ASCII => chữ Đ/đ đầu câu ghi rõ cả 2 dạng;
+# các dạng hoa khác (vd "ĐÃ HẾT SỐ LƯỢNG...") do _FULL_KEY_CF bắt ở bước dự phòng trong classify_response
+_RESP_RE = re.compile(
+    (r"((?-i:!!!True\|~~\|))"
+     r"|((?:đ|Đ)ã hết số lượng đăng ký phiên này|het so luong dang ky phien nay|session is full)"
+     r"|(captcha)").encode(),
+    re.I,
+)
+_FULL_KEY_CF = "đã hết số lượng đăng ký phiên này"
+
+# 2Captcha captcha_id -> Future chờ kết quả pingback
+CAPTCHA_FUTURES: Dict[str, asyncio.Future] = {}
+# captcha_id -> (thời điểm poll kế tiếp (monotonic), số lần đã poll); dùng khi không có pingback
+CAPTCHA_NEXT_POLL: Dict[str, Tuple[float, int]] = {}
+_captcha_poller: Optional[asyncio.Task] = None
 
 # Pending manual captcha (nếu không dùng 2Captcha)
-PENDING_CAPTCHAS: Dict[str, Dict[str, Any]] = {}
-PENDING_LOCK = threading.Lock()
+# chat_id -> hàng đợi (key, data) theo thứ tự đã gửi ảnh captcha
+PENDING_CAPTCHAS: Dict[int, Deque[Tuple[str, Dict[str, Any]]]] = defaultdict(deque)
+
+
+# Lỗi chắc chắn request CHƯA tới server (chưa kết nối được / chưa lấy được kết nối trong pool)
+_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """
+    Lỗi mạng / timeout / 5xx / 408 / 429 => đáng thử lại;
+    4xx khác là lỗi của request, thử lại cũng vậy.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+        return code >= 500 or code in (408, 429)
+    return isinstance(exc, (httpx.TransportError, httpx.TimeoutException))
+
+
+# Backoff có jitter: các task ngày chạy song song không retry cùng một nhịp
+_RETRY_WAIT = wait_exponential_jitter(initial=0.5, max=5, jitter=0.5)
+retry_transient = retry(stop=stop_after_attempt(3), wait=_RETRY_WAIT,
+                        retry=retry_if_exception(_is_transient), reraise=True)
+# Cho POST không idempotent (submit): chỉ thử lại khi chắc chắn request chưa tới server,
+# tránh đăng ký 2 lần khi bị timeout lúc đang chờ phản hồi
+retry_unsent = retry(stop=stop_after_attempt(3), wait=_RETRY_WAIT,
+                     retry=retry_if_exception_type(_UNSENT_ERRORS),
+                     reraise=True)
 
 
 def _normalize_endpoints(base_url: str, pop_path: str, ajax_path: str):
@@ -78,8 +167,7 @@ def _normalize_endpoints(base_url: str, pop_path: str, ajax_path: str):
 
     page_url = urlunsplit((sp.scheme, sp.netloc, page_path, "", ""))
     ajax_url = urlunsplit((sp.scheme, sp.netloc, (root_path.rstrip("/") + ajax_path), "", ""))
-    page_dir = page_path.rsplit("/", 1)[0] or "/"
-    ajax_alt_url = urlunsplit((sp.scheme, sp.netloc, (page_dir + ajax_path), "", ""))
+    ajax_alt_url = urlunsplit((sp.scheme, sp.netloc, (page_path.rstrip("/") + ajax_path), "", ""))
     root_base_url = urlunsplit((sp.scheme, sp.netloc, root_path if root_path else "/", "", ""))
 
     return page_url, ajax_url, ajax_alt_url, root_base_url
@@ -93,63 +181,142 @@ class PopmartClient:
          self.ajax_alt_url,
          self.root_base_url) = _normalize_endpoints(base_url, pop_path, ajax_path)
 
-        self.session = requests.Session()
-        self.session.headers.update({
-            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124 Safari/537.36"
-        })
+        # 1 pool kết nối (HTTP/2 + keep-alive) dùng chung cho mọi ngày / mọi dòng / mọi fork()
+        self._transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=HTTP_POOL_SIZE,
+                max_connections=HTTP_POOL_SIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
         self.timeout = timeout
+        self.http = self._new_http()
+        self._owns_transport = True
+        # Captcha gắn với cookie phiên của client: LoadCaptcha mới thay đáp án server đang chờ.
+        # Giữ lock từ LoadCaptcha tới khi submit xong => mỗi cookie jar chỉ có 1 captcha "đang dùng".
+        self.captcha_lock = asyncio.Lock()
+        # URL Ajax đang dùng: bắt đầu từ ajax_url, gặp 404 mà alt chạy được thì chuyển hẳn sang alt
+        self._ajax_primary = self.ajax_url
+        # Dùng chung với các fork (copy.copy giữ nguyên tham chiếu)
+        self._sessions_cache: TTLCache = TTLCache(maxsize=SESSIONS_CACHE_MAX, ttl=SESSIONS_CACHE_TTL)
         log.info(f"[ENDPOINTS] page={self.page_url} | ajax={self.ajax_url} | ajax_alt={self.ajax_alt_url} | root={self.root_base_url}")
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def get_main_page(self) -> str:
-        r = self.session.get(self.page_url, timeout=self.timeout)
-        r.raise_for_status()
-        return r.text
-
-    def _ajax_get(self, params: Dict[str, str]) -> requests.Response:
-        r = self.session.get(self.ajax_url, params=params, timeout=self.timeout, allow_redirects=True)
-        if r.status_code == 404:
-            r2 = self.session.get(self.ajax_alt_url, params=params, timeout=self.timeout, allow_redirects=True)
-            r2.raise_for_status()
-            return r2
+    def _new_http(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            transport=self._transport,
+            timeout=self.timeout,
+            follow_redirects=True,
+            headers={
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124 Safari/537.36"
+            },
+        )
+
+    def fork(self) -> "PopmartClient":
+        """
+        Client con: dùng chung pool kết nối + cache của client gốc nhưng cookie jar (=> captcha/phiên) riêng,
+        để nhiều dòng cùng ngày giữ captcha của mình song song mà không đè nhau.
+        """
+        c = copy.copy(self)
+        c.http = self._new_http()
+        c._owns_transport = False
+        c.captcha_lock = asyncio.Lock()
+        return c
+
+    async def aclose(self):
+        # fork() không đóng pool dùng chung (AsyncClient.aclose sẽ đóng luôn transport)
+        if self._owns_transport:
+            await self.http.aclose()
+
+    async def prewarm(self):
+        """Mở sẵn 1 kết nối keep-alive (DNS + TCP + TLS) tới site; lỗi chỉ log."""
+        try:
+            r = await self.http.head(self.page_url)
+            log.info(f"[PREWARM] {self.page_url} -> {r.status_code} ({r.http_version})")
+        except Exception as e:
+            log.warning(f"[PREWARM] {self.page_url} failed: {e}")
+
+    @retry_transient
+    async def get_main_page(self) -> bytes:
+        r = await self.http.get(self.page_url)
         r.raise_for_status()
-        return r
+        return r.content
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def load_sessions_for_day(self, id_ngay: str) -> List[Dict[str, str]]:
-        r = self._ajax_get({"Action": "LoadPhien", "idNgayBanHang": id_ngay})
-        html = r.text.split("||@@||")[0]
-        soup = BeautifulSoup(html, "html.parser")
-        return [{"value": (opt.get("value") or "").strip(), "label": (opt.text or "").strip()}
-                for opt in soup.find_all("option")]
-
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def fetch_captcha_image_url(self) -> Optional[str]:
-        r = self._ajax_get({"Action": "LoadCaptcha"})
-        soup = BeautifulSoup(r.text, "html.parser")
-        img = soup.find("img")
-        if img and img.get("src"):
-            src = img["src"].strip()
-            if src.startswith("http"):
-                return src
-            root = self.ajax_url.rsplit("/", 1)[0]
-            return f"{root}/{src.lstrip('./')}"
-        return None
+    async def _ajax(self, method: str, raise_4xx: bool = True, **kwargs) -> httpx.Response:
+        """raise_4xx=False: 4xx trả về response (để đọc thông báo lỗi trong body), chỉ raise với 5xx."""
+        r = await self.http.request(method, self._ajax_primary, **kwargs)
+        if r.status_code == 404 and self._ajax_primary != self.ajax_alt_url:
+            r2 = await self.http.request(method, self.ajax_alt_url, **kwargs)
+            if r2.status_code != 404:
+                log.info(f"[ENDPOINTS] {self._ajax_primary} -> 404, dùng hẳn {self.ajax_alt_url}")
+                self._ajax_primary = self.ajax_alt_url
+            r = r2
+        if raise_4xx or r.status_code >= 500:
+            r.raise_for_status()
+        return r
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def download_image(self, url: str) -> bytes:
-        r = self.session.get(url, timeout=self.timeout)
+    async def _ajax_get(self, params: Dict[str, str]) -> httpx.Response:
+        return await self._ajax("GET", params=params)
+
+    async def load_sessions_for_day(self, id_ngay: str) -> List[Dict[str, str]]:
+        """LoadPhien có cache TTL (SESSIONS_CACHE_TTL) theo id_ngay; chỉ cache khi có phiên."""
+        hit = self._sessions_cache.get(id_ngay)
+        if hit is not None:
+            return hit
+        sessions = await self._fetch_sessions_for_day(id_ngay)
+        if sessions:
+            self._sessions_cache[id_ngay] = sessions
+        return sessions
+
+    @retry_transient
+    async def _fetch_sessions_for_day(self, id_ngay: str) -> List[Dict[str, str]]:
+        r = await self._ajax_get({"Action": "LoadPhien", "idNgayBanHang": id_ngay})
+        html = r.content.split(b"||@@||")[0]
+        return [{"value": (opt.attributes.get("value") or "").strip(), "label": (opt.text() or "").strip()}
+                for opt in LexborHTMLParser(html).css("option")]
+
+    @retry_transient
+    async def fetch_captcha_image(self) -> Optional[bytes]:
+        """
+        LoadCaptcha -> bytes ảnh captcha:
+          - server trả thẳng image/* => dùng luôn
+          - src là data URI => giải base64 tại chỗ, không thêm request nào
+          - còn lại => GET ảnh trên cùng AsyncClient (kết nối keep-alive đã mở sẵn)
+        """
+        r = await self._ajax_get({"Action": "LoadCaptcha"})
+        if r.headers.get("content-type", "").startswith("image/"):
+            return r.content
+        m = _IMG_SRC_RE.search(r.text)
+        if not m or not m.group(1).strip():
+            return None
+        src = m.group(1).strip()
+        if src.startswith("data:"):
+            head, _, data = src.partition(",")
+            return base64.b64decode(data) if head.endswith(";base64") else unquote_to_bytes(data)
+        if not src.startswith("http"):
+            root = self._ajax_primary.rsplit("/", 1)[0]
+            src = f"{root}/{src.lstrip('./')}"
+        img = await self.http.get(src)
+        img.raise_for_status()
+        return img.content
+
+    @retry_transient
+    async def download_image(self, url: str) -> bytes:
+        r = await self.http.get(url)
         r.raise_for_status()
         return r.content
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def submit_registration(self, payload: Dict[str, str]) -> str:
-        r = self._ajax_get(payload)
-        return r.text.strip()
+    @retry_unsent
+    async def submit_registration(self, payload: Dict[str, str]) -> bytes:
+        # POST form body: dữ liệu cá nhân không nằm trên URL (log/proxy), request line ngắn
+        # Trả bytes thô: các dấu hiệu cần dò đều là ASCII/UTF-8, không cần decode cả body
+        # 4xx (vd sai captcha) không raise: trả body để classify_response phân loại, không tốn thêm lượt retry
+        r = await self._ajax("POST", raise_4xx=False, data=payload)
+        return r.content.strip()
 
     # --- Extra endpoints to mirror real site ---
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def gen_qr_image(self, value: str, text: str) -> Optional[str]:
+    @retry_transient
+    async def gen_qr_image(self, value: str, text: str) -> Optional[str]:
         """
         POST JSON: {"GiaTri":"<MaThamDu>", "NoiDungHienBenDuoi":"<MaThamDu>"}
         to /DangKy.aspx/GenQRImage -> returns {"d":"<url_png>"}
@@ -157,98 +324,410 @@ class PopmartClient:
         url = f"{self.root_base_url.rstrip('/')}/DangKy.aspx/GenQRImage"
         headers = {"Content-Type": "application/json; charset=utf-8"}
         data = json.dumps({"GiaTri": value, "NoiDungHienBenDuoi": text})
-        r = self.session.post(url, data=data, headers=headers, timeout=self.timeout)
+        r = await self.http.post(url, content=data, headers=headers)
         r.raise_for_status()
         jr = r.json()
         return jr.get("d")
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=10), reraise=True)
-    def send_email(self, id_phien: str, ma_tham_du: str) -> bool:
-        r = self._ajax_get({"Action": "SendEmail", "idPhien": id_phien, "MaThamDu": ma_tham_du})
+    @retry_transient
+    async def send_email(self, id_phien: str, ma_tham_du: str) -> bool:
+        r = await self._ajax_get({"Action": "SendEmail", "idPhien": id_phien, "MaThamDu": ma_tham_du})
         return r.text.strip().lower() == "true"
 
-    def map_sales_date_to_id(self, html: str, target_date: str) -> Optional[str]:
-        soup = BeautifulSoup(html, "html.parser")
-        sel = soup.find("select", {"id": "slNgayBanHang"})
-        if not sel:
-            return None
-        for opt in sel.find_all("option"):
-            if (opt.text or "").strip() == target_date:
-                return (opt.get("value") or "").strip()
-        return None
+
+@functools.lru_cache(maxsize=8)
+def parse_sales_dates(html: bytes) -> Mapping[str, str]:
+    """
+    Parse <select id="slNgayBanHang"> 1 lần (lexbor) -> {ngày: idNgayBanHang} theo thứ tự trên trang.
+    Bỏ placeholder (thiếu text/value) và ngày trùng (giữ id của lần xuất hiện đầu).
+    Kết quả được lru_cache dùng chung => trả về bản chỉ đọc.
+    """
+    if not html:
+        return MappingProxyType({})
+    sel = LexborHTMLParser(html).css_first("select#slNgayBanHang")
+    if sel is None:
+        return MappingProxyType({})
+    out: Dict[str, str] = {}
+    for opt in sel.css("option"):
+        txt = (opt.text() or "").strip()
+        val = (opt.attributes.get("value") or "").strip()
+        if txt and val:
+            out.setdefault(txt, val)
+    return MappingProxyType(out)
 
 
-def extract_all_sales_dates(html: str) -> List[str]:
-    out: List[str] = []
-    soup = BeautifulSoup(html, "html.parser")
-    sel = soup.find("select", {"id": "slNgayBanHang"})
-    if not sel:
-        return out
-    for opt in sel.find_all("option"):
-        txt = (opt.text or "").strip()
-        val = (opt.get("value") or "").strip()
-        if txt and val:  # skip placeholder
-            out.append(txt)
-    return out
+# Client keep-alive riêng cho 2captcha.com (đóng ở on_shutdown)
+_2captcha_client = httpx.AsyncClient(base_url="https://2captcha.com", timeout=REQUEST_TIMEOUT)
 
 
-def solve_captcha_via_2captcha(image_bytes: bytes) -> Optional[str]:
+async def solve_captcha_via_2captcha(image_bytes: bytes) -> Optional[str]:
     if not TWO_CAPTCHA_API_KEY:
         return None
     try:
-        import time, base64
-        b64 = base64.b64encode(image_bytes).decode("ascii")
-        r = requests.post("https://2captcha.com/in.php",
-                          data={"key": TWO_CAPTCHA_API_KEY, "method": "base64", "body": b64, "json": 1},
-                          timeout=REQUEST_TIMEOUT)
+        # multipart (method=post): gửi thẳng bytes ảnh, không base64 (+33% kích thước)
+        data = {"key": TWO_CAPTCHA_API_KEY, "method": "post", "json": 1}
+        if PINGBACK_URL:
+            data["pingback"] = _pingback_url()
+        r = await _2captcha_client.post("/in.php", data=data,
+                                        files={"file": ("captcha.png", image_bytes, "image/png")})
         r.raise_for_status()
-        j = r.json()
+        j = orjson.loads(r.content)
         if j.get("status") != 1 or "request" not in j:
             return None
-        rid = j["request"]
-        end_time = time.time() + CAPTCHA_SOFT_TIMEOUT
-        while time.time() < end_time:
-            time.sleep(CAPTCHA_POLL_INTERVAL)
-            pr = requests.get("https://2captcha.com/res.php",
-                              params={"key": TWO_CAPTCHA_API_KEY, "action": "get", "id": rid, "json": 1},
-                              timeout=REQUEST_TIMEOUT)
-            pr.raise_for_status()
-            jr = pr.json()
-            if jr.get("status") == 1:
-                return str(jr.get("request", "")).strip()
-        return None
+        rid = str(j["request"])
     except Exception as e:
         log.warning(f"2Captcha error: {e}")
         return None
 
+    # Kết quả về qua pingback (handle_2captcha_pingback) hoặc task poll gom (_poll_captchas).
+    # Có pingback vẫn xếp lịch poll, chỉ lùi lại PINGBACK_GRACE giây: pingback lạc/không đăng ký thì poll bắt được.
+    fut = asyncio.get_running_loop().create_future()
+    CAPTCHA_FUTURES[rid] = fut
+    CAPTCHA_NEXT_POLL[rid] = (time.monotonic() + (PINGBACK_GRACE if PINGBACK_URL else CAPTCHA_FIRST_POLL), 0)
+    _ensure_captcha_poller()
+    try:
+        code = await asyncio.wait_for(fut, CAPTCHA_SOFT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    finally:
+        CAPTCHA_FUTURES.pop(rid, None)
+        CAPTCHA_NEXT_POLL.pop(rid, None)
+    return code or None
+
 
-def is_session_full(text: str) -> bool:
-    t = (text or "").lower()
-    keys = [
-        "đã hết số lượng đăng ký phiên này",
-        "het so luong dang ky phien nay",
-        "this session is full",
-        "session is full",
-    ]
-    return any(k in t for k in keys)
+def _pingback_url() -> str:
+    """PINGBACK_URL + token bí mật trong query."""
+    sp = urlsplit(PINGBACK_URL)
+    query = "&".join(q for q in (sp.query, urlencode({"token": PINGBACK_TOKEN})) if q)
+    return urlunsplit((sp.scheme, sp.netloc, sp.path, query, sp.fragment))
+
+
+def _resolve_captcha(rid: str, code: Optional[str]):
+    CAPTCHA_NEXT_POLL.pop(rid, None)
+    fut = CAPTCHA_FUTURES.pop(rid, None)
+    if fut and not fut.done():
+        fut.set_result(None if (not code or code.startswith("ERROR")) else code)
+
+
+def _ensure_captcha_poller():
+    global _captcha_poller
+    if _captcha_poller is None or _captcha_poller.done():
+        _captcha_poller = asyncio.create_task(_poll_captchas())
+
+
+async def _poll_captchas():
+    """
+    1 task nền cho mọi captcha đang chờ: gom các id đến hạn vào 1 lệnh res.php?action=get&ids=...
+    Mỗi id: lần poll đầu sau CAPTCHA_FIRST_POLL giây, sau đó giãn dần 2s, 3s, 4s... (tối đa CAPTCHA_POLL_INTERVAL).
+    """
+    while CAPTCHA_NEXT_POLL:
+        now = time.monotonic()
+        # gom luôn các id sắp đến hạn (<=0.5s) để dùng chung 1 request
+        due = [rid for rid, (t, _) in CAPTCHA_NEXT_POLL.items() if t <= now + 0.5]
+        if not due:
+            await asyncio.sleep(min(t for t, _ in CAPTCHA_NEXT_POLL.values()) - now)
+            continue
+
+        answers: List[str] = []
+        try:
+            r = await _2captcha_client.get("/res.php", params={
+                "key": TWO_CAPTCHA_API_KEY, "action": "get", "ids": ",".join(due), "json": 1,
+            })
+            r.raise_for_status()
+            answers = str(orjson.loads(r.content).get("request", "")).split("|")
+        except Exception as e:
+            log.warning(f"2Captcha poll error: {e}")
+        if len(answers) != len(due):
+            answers = []
+
+        now = time.monotonic()
+        for i, rid in enumerate(due):
+            ans = answers[i].strip() if answers else "CAPCHA_NOT_READY"
+            if ans != "CAPCHA_NOT_READY":
+                _resolve_captcha(rid, ans)
+            elif rid in CAPTCHA_NEXT_POLL:
+                tries = CAPTCHA_NEXT_POLL[rid][1] + 1
+                CAPTCHA_NEXT_POLL[rid] = (now + min(1 + tries, CAPTCHA_POLL_INTERVAL), tries)
+
+
+async def handle_2captcha_pingback(request: web.Request) -> web.Response:
+    """2Captcha gọi về: id=<captcha_id>&code=<answer> (query hoặc form), kèm ?token=PINGBACK_TOKEN."""
+    if not secrets.compare_digest(request.query.get("token", ""), PINGBACK_TOKEN):
+        log.warning(f"[2CAPTCHA] pingback bị từ chối (sai token) từ {request.remote}")
+        return web.Response(status=403, text="forbidden")
+    params = dict(request.query)
+    if request.method == "POST":
+        params.update(await request.post())
+    rid = str(params.get("id", "")).strip()
+    code = str(params.get("code", "")).strip()
+    _resolve_captcha(rid, code)
+    return web.Response(text="ok")
+
+
+class Outcome(enum.Enum):
+    """Kết quả xử lý 1 lượt (captcha + submit) của 1 dòng."""
+    SUCCESS = "success"
+    CAPTCHA_FAIL = "captcha_fail"  # sai captcha / 2Captcha không trả lời / lỗi tạm thời -> thử lại
+    HARD_FAIL = "hard_fail"        # không thử lại
+    SESSION_FULL = "session_full"
+    MANUAL = "manual"              # đã chuyển sang nhập captcha tay
+
+
+# chat_id -> thời điểm (loop.time()) sớm nhất được sửa tin nhắn tiếp theo trong chat.
+# Dùng chung cho mọi DayStatus cùng chat: giới hạn của Telegram là theo chat, không theo ngày.
+_CHAT_NEXT_EDIT: Dict[int, float] = {}
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+class DayStatus:
+    """
+    1 tin nhắn trạng thái cho mỗi ngày, sửa tại chỗ (edit_message_text); trong cùng 1 chat (mọi ngày cộng lại)
+    tối đa 1 lần sửa / MIN_EDIT_INTERVAL giây. Dòng mới luôn được hiện ra: nếu chưa tới lượt sửa thì 1 task
+    "trailing" sẽ sửa khi tới lượt. Sửa lỗi => giữ _dirty để lần sau (và close()) sửa lại.
+    Ảnh QR của các dòng thành công được gom thành album (send_media_group), mỗi album tối đa PHOTO_BATCH ảnh.
+    """
+    MAX_LINES = 20
+    MAX_LINE_LEN = 150
+    MIN_EDIT_INTERVAL = 1.0
+    PHOTO_BATCH = 10  # giới hạn số ảnh / album của Telegram
+    CLOSE_RETRIES = 3
+
+    def __init__(self, bot, chat_id: int, day: str, total: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.day = day
+        self.total = total
+        self.done = 0
+        self.events: List[str] = []
+        self.message_id: Optional[int] = None
+        self._dirty = False
+        self._trailing: Optional[asyncio.Task] = None
+        self._photos: List[Tuple[bytes, str]] = []
+
+    def _render(self) -> str:
+        return "\n".join([f"[{self.day}] Đã xử lý {self.done}/{self.total} dòng", *self.events[-self.MAX_LINES:]])
+
+    def _push_next_edit(self, delay: float):
+        at = asyncio.get_running_loop().time() + delay
+        _CHAT_NEXT_EDIT[self.chat_id] = max(_CHAT_NEXT_EDIT.get(self.chat_id, 0.0), at)
+
+    def _reserve_slot(self) -> float:
+        """Giữ 1 lượt sửa trong chat; trả về số giây phải chờ tới lượt đó."""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, _CHAT_NEXT_EDIT.get(self.chat_id, 0.0))
+        _CHAT_NEXT_EDIT[self.chat_id] = slot + self.MIN_EDIT_INTERVAL
+        return slot - now
+
+    async def start(self):
+        msg = await self.bot.send_message(chat_id=self.chat_id, text=self._render())
+        self.message_id = msg.message_id
+        self._push_next_edit(self.MIN_EDIT_INTERVAL)
+
+    async def add(self, line: str, rows: int = 1, force: bool = False):
+        self.done += rows
+        self.events.append(line[:self.MAX_LINE_LEN])
+        self._dirty = True
+        if force:
+            await self.flush()
+        elif self._trailing is None or self._trailing.done():
+            self._trailing = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(self._reserve_slot())
+            if await self.flush() is None and self._dirty:
+                return  # lỗi khác RetryAfter: để dành cho lần add()/close() sau
+
+    async def flush(self) -> Optional[float]:
+        """Sửa tin nhắn ngay. Bị RetryAfter => trả về số giây phải chờ; mọi lỗi đều giữ lại _dirty."""
+        if not self._dirty or self.message_id is None:
+            return None
+        self._dirty = False
+        self._push_next_edit(self.MIN_EDIT_INTERVAL)
+        try:
+            await self.bot.edit_message_text(text=self._render(), chat_id=self.chat_id, message_id=self.message_id)
+        except RetryAfter as e:
+            self._dirty = True
+            wait = _retry_after_seconds(e)
+            self._push_next_edit(wait)
+            log.warning(f"[{self.day}] status edit rate-limited, retry after {wait}s")
+            return wait
+        except Exception as e:
+            self._dirty = True
+            log.warning(f"[{self.day}] status edit failed: {e}")
+        return None
+
+    async def close(self):
+        """Kết thúc ngày: bỏ task trailing, sửa lần cuối (chờ RetryAfter nếu bị giới hạn) để số đếm/dòng cuối đúng."""
+        if self._trailing is not None and not self._trailing.done():
+            self._trailing.cancel()
+            try:
+                await self._trailing
+            except asyncio.CancelledError:
+                pass
+        for _ in range(self.CLOSE_RETRIES):
+            if not self._dirty:
+                break
+            # _reserve_slot() đã tính cả thời gian RetryAfter của lần trước
+            await asyncio.sleep(self._reserve_slot())
+            if await self.flush() is None and self._dirty:
+                break  # lỗi không phải rate-limit: đã log, không thử mãi
+
+    async def add_photo(self, photo: bytes, caption: str):
+        self._photos.append((photo, caption))
+        if len(self._photos) >= self.PHOTO_BATCH:
+            await self.flush_photos()
+
+    async def flush_photos(self):
+        batch, self._photos = self._photos, []
+        if not batch:
+            return
+        try:
+            try:
+                await self._send_photos(batch, "Markdown")
+            except BadRequest as e:
+                # caption chứa slabel/mã do site trả về: 1 caption lỗi Markdown làm hỏng cả album
+                log.warning(f"[{self.day}] QR album Markdown rejected ({e}), resend plain")
+                await self._send_photos(batch, None)
+        except Exception as e:
+            log.warning(f"[{self.day}] QR album ({len(batch)} ảnh) failed: {e}")
+
+    async def _send_photos(self, batch, parse_mode):
+        if len(batch) == 1:
+            photo, caption = batch[0]
+            await self.bot.send_photo(chat_id=self.chat_id, photo=photo,
+                                      caption=caption, parse_mode=parse_mode)
+        else:
+            await self.bot.send_media_group(chat_id=self.chat_id, media=[
+                InputMediaPhoto(media=photo, caption=caption, parse_mode=parse_mode)
+                for photo, caption in batch
+            ])
+
+
+_RESP_KINDS = {1: Outcome.SUCCESS, 2: Outcome.SESSION_FULL, 3: Outcome.CAPTCHA_FAIL}
+
+
+def classify_response(body: bytes) -> Outcome:
+    """Thành công > hết lượt > sai captcha (thứ tự ưu tiên như trước); không khớp gì => HARD_FAIL."""
+    best = None
+    for m in _RESP_RE.finditer(body or b""):
+        if best is None or m.lastindex < best:
+            best = m.lastindex
+            if best == 1:
+                break
+    # Dự phòng cho chữ hoa tiếng Việt (ngoài ASCII): chỉ decode + casefold khi chưa thấy thành công/hết lượt
+    if best not in (1, 2) and body and not body.isascii():
+        if _FULL_KEY_CF in body.decode("utf-8", "ignore").casefold():
+            best = 2
+    return _RESP_KINDS.get(best, Outcome.HARD_FAIL)
+
+
+def _ma_tham_du(body: bytes) -> str:
+    """Phản hồi thành công: !!!True|~~|...|~~|...|~~|<MaThamDu>"""
+    arr = body.split(b"|~~|")
+    return arr[3].strip().decode("utf-8", "replace") if len(arr) > 3 else ""
+
+
+def _preview(body: Optional[bytes], n: int = 200) -> str:
+    """n byte đầu của phản hồi để báo lỗi / ghi báo cáo (bỏ ký tự UTF-8 bị cắt dở)."""
+    return (body or b"")[:n].decode("utf-8", "ignore")
+
+
+async def after_success(client: PopmartClient, sid: str, ma: str, tag: str, on_qr) -> None:
+    """
+    Các bước sau 1 submit thành công (dùng chung auto + manual): QR -> on_qr(qr_abs, qr_bytes) -> SendEmail.
+    Đã đăng ký xong nên mọi bước đều best-effort: lỗi chỉ log, không đổi kết quả dòng; on_qr luôn được gọi
+    (qr rỗng nếu lỗi) để báo cáo Success vẫn được ghi.
+    """
+    qr_abs = ""
+    qr_bytes = None
+    try:
+        qr_url = await client.gen_qr_image(ma, ma)
+        if qr_url:
+            qr_abs = qr_url if qr_url.startswith("http") else f"{client.root_base_url.rstrip('/')}{qr_url}"
+            qr_bytes = await client.download_image(qr_abs)
+    except Exception as e:
+        log.warning(f"[{tag}] QR for {ma} failed: {e}")
+    try:
+        await on_qr(qr_abs, qr_bytes)
+    except Exception as e:
+        log.warning(f"[{tag}] Telegram notify for {ma} failed: {e}")
+    try:
+        await client.send_email(sid, ma)
+    except Exception as e:
+        log.warning(f"[{tag}] SendEmail for {ma} failed: {e}")
 
 
 def is_admin(uid: int) -> bool:
     return not ADMINS or str(uid) in ADMINS
 
 
-def build_payload(id_ngay: str, id_phien: str, row: Dict[str, Any], captcha_text: str) -> Dict[str, str]:
+_SHEET_INDEX = 0  # chỉ đọc sheet đầu tiên của file upload
+
+
+def _read_sheet_values(buf: BinaryIO) -> List[Any]:
+    """
+    Giá trị các ô của sheet đầu tiên: calamine nếu có, không thì openpyxl (streaming, read_only).
+    Hai nhánh phải cho cùng 1 lưới: cùng sheet (thứ tự _SHEET_INDEX, như pd.read_excel, không phải sheet active)
+    và tính từ ô A1 (không cắt hàng/cột trống ở đầu).
+    """
+    if CalamineWorkbook is not None:
+        sheet = CalamineWorkbook.from_filelike(buf).get_sheet_by_index(_SHEET_INDEX)
+        return sheet.to_python(skip_empty_area=False)
+    wb = openpyxl.load_workbook(buf, read_only=True, data_only=True)
+    try:
+        return list(wb.worksheets[_SHEET_INDEX].iter_rows(values_only=True))
+    finally:
+        wb.close()
+
+
+def read_excel_rows(buf: BinaryIO) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """Đọc sheet đầu tiên -> (headers, rows dạng dict). Bỏ qua dòng trống."""
+    values = _read_sheet_values(buf)
+    if not values:
+        return [], []
+    headers = [str(h).strip() if h is not None else "" for h in values[0]]
+    rows = [dict(zip(headers, r)) for r in values[1:] if any(v is not None and v != "" for v in r)]
+    return headers, rows
+
+
+def _as_int_str(v: Any) -> str:
+    if v is None or (isinstance(v, str) and not v.strip()):
+        return ""
+    return str(int(float(v)))
+
+
+def _as_str(v: Any) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():  # calamine trả số dạng float: 912345678.0 -> "912345678"
+        v = int(v)
+    return str(v).strip()
+
+
+def build_row_template(row: Dict[str, Any]) -> Dict[str, str]:
+    """Phần payload cố định của 1 dòng (row đã được chuẩn hoá kiểu ở handle_excel)."""
     return {
+        "HoTen": row["FullName"],
+        "NgaySinh_Ngay": row["DOB_Day"],
+        "NgaySinh_Thang": row["DOB_Month"],
+        "NgaySinh_Nam": row["DOB_Year"],
+        "SoDienThoai": row["Phone"],
+        "Email": row["Email"],
+        "CCCD": row["IDNumber"],
+    }
+
+
+def build_payload(id_ngay: str, id_phien: str, base: Dict[str, str], captcha_text: str) -> Dict[str, str]:
+    return {
+        **base,
         "Action": "DangKyThamDu",
         "idNgayBanHang": id_ngay,
         "idPhien": id_phien,
-        "HoTen": str(row["FullName"]).strip(),
-        "NgaySinh_Ngay": str(int(row["DOB_Day"])),
-        "NgaySinh_Thang": str(int(row["DOB_Month"])),
-        "NgaySinh_Nam": str(int(row["DOB_Year"])),
-        "SoDienThoai": str(row["Phone"]).strip(),
-        "Email": str(row["Email"]).strip(),
-        "CCCD": str(row["IDNumber"]).strip(),
         "Captcha": captcha_text.strip(),
     }
 
@@ -272,9 +751,15 @@ async def handle_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     file = await doc.get_file()
-    df = pd.read_excel(io.BytesIO(await file.download_as_bytearray()))
+    # tải thẳng vào 1 BytesIO (không qua bytearray -> bytes -> BytesIO, mỗi bước 1 bản sao)
+    buf = io.BytesIO()
+    await file.download_to_memory(out=buf)
+    buf.seek(0)
+    # parse xlsx là CPU-bound: chạy ngoài event loop để không chặn các task ngày đang chạy
+    headers, rows = await asyncio.to_thread(read_excel_rows, buf)
     required = ["FullName", "DOB_Day", "DOB_Month", "DOB_Year", "Phone", "Email", "IDNumber"]
-    missing = [c for c in required if c not in df.columns]
+    header_set = set(headers)
+    missing = [c for c in required if c not in header_set]
     if missing:
         await update.message.reply_text(
             "❌ File thiếu cột bắt buộc: " + ", ".join(missing) +
@@ -282,226 +767,289 @@ async def handle_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    rows = df.to_dict(orient="records")
-    for idx, r in enumerate(rows):
-        r["__row_idx"] = idx
+    # Chuẩn hoá kiểu 1 lần khi đọc file (thay vì str()/int() mỗi lần build_payload).
+    # Ô không hợp lệ (vd DOB_Day="abc", ô kiểu ngày) chỉ làm hỏng dòng đó: dòng bị ghi Failed, các dòng khác vẫn chạy.
+    bad_rows: Dict[int, str] = {}  # row_idx -> cột lỗi đầu tiên
+    for i, r in enumerate(rows):
+        for c in required:
+            conv = _as_int_str if c in ("DOB_Day", "DOB_Month", "DOB_Year") else _as_str
+            try:
+                r[c] = conv(r[c])
+            except (TypeError, ValueError, OverflowError):
+                bad_rows.setdefault(i, c)
+                r[c] = "" if r[c] is None else str(r[c]).strip()
+    row_templates = [build_row_template(r) for r in rows]
+    if bad_rows:
+        await update.message.reply_text(
+            f"⚠️ {len(bad_rows)} dòng có dữ liệu không hợp lệ, sẽ bỏ qua: " +
+            ", ".join(f"Dòng {i + 1} ({c})" for i, c in sorted(bad_rows.items()))
+        )
+        if len(bad_rows) == len(rows):
+            return
 
-    client = PopmartClient(BASE_URL, POP_PAGE_PATH, AJAX_PATH, REQUEST_TIMEOUT)
+    client: PopmartClient = context.application.bot_data["client"]
 
     # Sales dates
-    main_html = await asyncio.to_thread(client.get_main_page)
-    all_days = extract_all_sales_dates(main_html)
-    if not all_days:
+    main_html = await client.get_main_page()
+    day_to_id = parse_sales_dates(main_html)
+    if not day_to_id:
         await update.message.reply_text("Không tìm thấy Sales Dates trên form.")
         return
 
-    unique_days = list(dict.fromkeys(all_days))
     # Anti-dup scheduling
     days_to_run = []
-    with ACTIVE_LOCK:
-        for d in unique_days:
-            if d in ACTIVE_DAYS:
-                continue  # đang chạy ở 1 tác vụ khác
-            if (not DISABLE_GLOBAL_DAY_DEDUP) and (d in COMPLETED_DAYS):
-                continue  # chỉ chặn nếu bật dedup toàn cục
-            ACTIVE_DAYS.add(d)
-            days_to_run.append(d)
+    for d in day_to_id:
+        if d in ACTIVE_DAYS:
+            continue  # đang chạy ở 1 tác vụ khác
+        if (not DISABLE_GLOBAL_DAY_DEDUP) and (d in COMPLETED_DAYS):
+            continue  # chỉ chặn nếu bật dedup toàn cục
+        ACTIVE_DAYS.add(d)
+        days_to_run.append(d)
 
     if not days_to_run:
         await update.message.reply_text("Không có ngày nào mới để chạy (đã chạy trước đó).")
         return
 
-    await update.message.reply_text(f"Tìm thấy {len(days_to_run)} ngày. Sẽ tạo {len(days_to_run)} task (mỗi ngày 1 task).")
-
-    # Each day -> all rows
-    buckets: Dict[str, List[Dict[str, Any]]] = {d: list(rows) for d in days_to_run}
-    report_rows: List[Dict[str, Any]] = []
-    report_lock = asyncio.Lock()
-
-    async def add_report(**kw):
-        async with report_lock:
-            report_rows.append(kw)
-
-    async def process_day(day: str, tasks: List[Dict[str, Any]]):
-        try:
-            html = await asyncio.to_thread(client.get_main_page)
-            id_ngay = client.map_sales_date_to_id(html, day)
+    try:
+        await update.message.reply_text(f"Tìm thấy {len(days_to_run)} ngày. Sẽ tạo {len(days_to_run)} task (mỗi ngày 1 task).")
+
+        report_rows: List[Dict[str, Any]] = []
+        report_lock = asyncio.Lock()
+        # Giới hạn tổng số lượt lấy captcha đồng thời (mọi ngày) lên popmart
+        captcha_sem = asyncio.Semaphore(MAX_WORKERS_CAP)
+
+        async def add_report(**kw):
+            async with report_lock:
+                report_rows.append(kw)
+
+        async def add_row_report(day: str, id_ngay: str, session: Dict[str, str], row_idx: int,
+                                 status: str, attempts: int, message: str, ma: str = "", qr_url: str = ""):
+            row = rows[row_idx]
+            await add_report(
+                Day=day, DayId=id_ngay, SessionValue=session.get("value", ""), SessionLabel=session.get("label", ""),
+                Row=row_idx + 1, FullName=row["FullName"],
+                DOB_Day=row["DOB_Day"], DOB_Month=row["DOB_Month"], DOB_Year=row["DOB_Year"],
+                Phone=row["Phone"], Email=row["Email"], IDNumber=row["IDNumber"],
+                Status=status, Attempts=attempts, Message=message,
+                MaThamDu=ma, QrUrl=qr_url, Timestamp=datetime.now().isoformat(timespec="seconds"),
+            )
+
+        async def ensure_day(day: str, id_ngay: Optional[str], tasks: List[int],
+                             status: DayStatus) -> Optional[Dict[str, str]]:
+            """Phiên sẽ đăng ký cho ngày này (phiên đầu tiên); None nếu không chạy được (đã ghi báo cáo)."""
             if not id_ngay:
-                await update.message.reply_text(f"[{day}] Không tìm thấy idNgàyBanHang.")
-                for row in tasks:
-                    await add_report(
-                        Day=day, DayId="", SessionValue="", SessionLabel="",
-                        Row=row["__row_idx"] + 1, FullName=row["FullName"],
-                        DOB_Day=row["DOB_Day"], DOB_Month=row["DOB_Month"], DOB_Year=row["DOB_Year"],
-                        Phone=row["Phone"], Email=row["Email"], IDNumber=row["IDNumber"],
-                        Status="Failed", Attempts=0, Message="Không tìm thấy idNgàyBanHang",
-                        MaThamDu="", QrUrl="", Timestamp=datetime.now().isoformat(timespec="seconds"),
-                    )
-                return
-
-            sessions = await asyncio.to_thread(client.load_sessions_for_day, id_ngay)
+                await status.add("❌ Không tìm thấy idNgàyBanHang.", rows=len(tasks), force=True)
+                for row_idx in tasks:
+                    await add_row_report(day, "", {}, row_idx, "Failed", 0, "Không tìm thấy idNgàyBanHang")
+                return None
+
+            sessions = await client.load_sessions_for_day(id_ngay)
             if not sessions:
-                await update.message.reply_text(f"[{day}] Không có phiên để đăng ký. Bỏ qua.")
-                for row in tasks:
-                    await add_report(
-                        Day=day, DayId=id_ngay, SessionValue="", SessionLabel="",
-                        Row=row["__row_idx"] + 1, FullName=row["FullName"],
-                        DOB_Day=row["DOB_Day"], DOB_Month=row["DOB_Month"], DOB_Year=row["DOB_Year"],
-                        Phone=row["Phone"], Email=row["Email"], IDNumber=row["IDNumber"],
-                        Status="Skipped", Attempts=0, Message="Không có phiên",
-                        MaThamDu="", QrUrl="", Timestamp=datetime.now().isoformat(timespec="seconds"),
-                    )
-                return
-
-            target_session = sessions[0]  # always pick first
-            sid = target_session["value"]
-            slabel = target_session["label"]
-
-            for idx_row, row in enumerate(tasks):
-                attempt = 0
-                success = False
-                last_msg = ""
-
-                while attempt < CAPTCHA_MAX_TRIES and not success:
-                    attempt += 1
+                await status.add("⏭️ Không có phiên để đăng ký. Bỏ qua.", rows=len(tasks), force=True)
+                for row_idx in tasks:
+                    await add_row_report(day, id_ngay, {}, row_idx, "Skipped", 0, "Không có phiên")
+                return None
+
+            return sessions[0]  # always pick first
+
+        async def attempt_row(lane: PopmartClient, day: str, id_ngay: str, session: Dict[str, str], row_idx: int,
+                              attempt: int, captcha_answer: str, status: DayStatus) -> Tuple[Outcome, str]:
+            """Submit 1 lần với captcha đã giải (qua đúng client đã lấy captcha). Khi thành công: QR + Telegram + email + báo cáo."""
+            sid = session["value"]
+            slabel = session["label"]
+            result = await lane.submit_registration(
+                build_payload(id_ngay, sid, row_templates[row_idx], captcha_answer)
+            )
+            kind = classify_response(result)
+            if kind is Outcome.SUCCESS:
+                # Parse MaThamDu + HTML xác nhận
+                ma = _ma_tham_du(result)
+
+                async def on_qr(qr_abs: str, qr_bytes: Optional[bytes]):
+                    await add_row_report(day, id_ngay, session, row_idx, "Success", attempt, "OK", ma=ma, qr_url=qr_abs)
+                    # Gửi về Telegram: dòng trạng thái + ảnh QR (nếu có)
+                    await status.add(f"✅ Dòng {row_idx + 1} — Mã tham dự: {ma}")
+                    if qr_bytes:
+                        cap = (
+                            f"✅ [{day}] Dòng {row_idx + 1}\n"
+                            f"Mã tham dự: `{ma}`\nPhiên: {slabel} ({sid})"
+                        )
+                        await status.add_photo(qr_bytes, cap)
+
+                # Đã đăng ký xong: lỗi ở các bước sau chỉ log, không được làm dòng này bị submit lại
+                await after_success(client, sid, ma, day, on_qr)
+                return Outcome.SUCCESS, "OK"
+            if kind is Outcome.SESSION_FULL:
+                return Outcome.SESSION_FULL, "Session full"
+            if kind is Outcome.CAPTCHA_FAIL:
+                return Outcome.CAPTCHA_FAIL, f"Sai captcha (thử {attempt}/{CAPTCHA_MAX_TRIES})."
+            return Outcome.HARD_FAIL, f"Không thành công: {_preview(result)}"
+
+        async def handle_manual(day: str, id_ngay: str, session: Dict[str, str], row_idx: int, img_bytes: bytes) -> bool:
+            """
+            Không dùng 2Captcha: gửi ảnh captcha cho người dùng, chờ handle_text.
+            Chỉ xếp vào PENDING_CAPTCHAS khi ảnh đã gửi được; lỗi Telegram chỉ làm hỏng dòng này (trả False).
+            """
+            caption = (
+                escape_markdown(f"[{day}] Dòng {row_idx + 1}: Vui lòng trả lời tin nhắn này bằng ", version=2)
+                + "*mã captcha*" + escape_markdown(".", version=2)
+            )
+            try:
+                await update.message.reply_photo(photo=img_bytes, caption=caption, parse_mode="MarkdownV2")
+            except Exception as e:
+                log.warning(f"[{day}] sending captcha for row {row_idx + 1} failed: {e}")
+                return False
+            key = f"{update.effective_chat.id}:{day}:{row_idx}"
+            PENDING_CAPTCHAS[update.effective_chat.id].append((key, {
+                "id_ngay": id_ngay,
+                "id_phien": session["value"],
+                "row": rows[row_idx],
+                "row_idx": row_idx,
+                "base": row_templates[row_idx],
+                "meta": {
+                    "Day": day, "DayId": id_ngay, "SessionValue": session["value"], "SessionLabel": session["label"]
+                },
+                "report_list": report_rows,
+                "report_lock": report_lock,
+            }))
+            return True
+
+        async def process_day(day: str, id_ngay: Optional[str], tasks: List[int]):
+            status = DayStatus(context.bot, update.effective_chat.id, day, len(tasks))
+            try:
+                await status.start()
+                session = await ensure_day(day, id_ngay, tasks, status)
+                if not session:
+                    return
+
+                # Mỗi dòng: lấy captcha -> giải -> submit liền mạch, giữ captcha_lock của client suốt chu trình
+                # (LoadCaptcha mới sẽ thay đáp án server đang chờ). Tối đa ROW_CONCURRENCY dòng song song,
+                # mỗi dòng song song 1 client fork (cookie jar riêng); 1 => dùng client chung, tuần tự như cũ.
+                # day_closed: phiên đã hết lượt -> không lấy/giải thêm captcha nào nữa.
+                day_closed = asyncio.Event()
+                pending = set(tasks)  # dòng chưa bắt đầu
+                n_lanes = min(ROW_CONCURRENCY, len(tasks)) if USE_2CAPTCHA else 1
+                lane_list = [client] if n_lanes <= 1 else [client.fork() for _ in range(n_lanes)]
+                lanes: asyncio.Queue = asyncio.Queue()
+                for lane in lane_list:
+                    lanes.put_nowait(lane)
+
+                async def run_attempt(lane: PopmartClient, row_idx: int, attempt: int) -> Tuple[Outcome, str]:
+                    async with lane.captcha_lock:
+                        try:
+                            async with captcha_sem:
+                                img_bytes = await lane.fetch_captcha_image()
+                        except Exception as e:
+                            log.warning(f"[{day}] captcha attempt {attempt} for row {row_idx + 1} failed: {e}")
+                            return Outcome.CAPTCHA_FAIL, f"Lỗi attempt {attempt}: {e}"
+                        if not img_bytes:
+                            return Outcome.HARD_FAIL, "Không lấy được captcha."
+                        if not USE_2CAPTCHA:
+                            if await handle_manual(day, id_ngay, session, row_idx, img_bytes):
+                                return Outcome.MANUAL, ""
+                            return Outcome.HARD_FAIL, "Không gửi được ảnh captcha."
+                        if day_closed.is_set():
+                            return Outcome.CAPTCHA_FAIL, "Session full"
+                        try:
+                            captcha_answer = await solve_captcha_via_2captcha(img_bytes)
+                        except Exception as e:
+                            log.warning(f"[{day}] 2Captcha attempt {attempt} for row {row_idx + 1} failed: {e}")
+                            return Outcome.CAPTCHA_FAIL, f"Lỗi attempt {attempt}: {e}"
+                        if not captcha_answer:
+                            return Outcome.CAPTCHA_FAIL, "2Captcha không trả lời."
+                        if day_closed.is_set():
+                            return Outcome.CAPTCHA_FAIL, "Session full"
+                        try:
+                            return await attempt_row(lane, day, id_ngay, session, row_idx, attempt, captcha_answer, status)
+                        except _UNSENT_ERRORS as e:
+                            # request chưa tới server => lấy captcha mới và thử lại an toàn
+                            log.warning(f"[{day}] submit attempt {attempt} for row {row_idx + 1} not sent: {e}")
+                            return Outcome.CAPTCHA_FAIL, f"Lỗi attempt {attempt}: {e}"
+                        except Exception as e:
+                            # POST có thể đã tới server (timeout đọc, 5xx, ...) => không submit lại, tránh đăng ký 2 lần
+                            log.warning(f"[{day}] submit attempt {attempt} for row {row_idx + 1} failed after send: {e}")
+                            return Outcome.HARD_FAIL, f"Không rõ kết quả (không thử lại, kiểm tra thủ công): {e}"
+
+                async def do_row(row_idx: int):
+                    lane = await lanes.get()
                     try:
-                        img_url = await asyncio.to_thread(client.fetch_captcha_image_url)
-                        if not img_url:
-                            last_msg = "Không lấy được captcha."
-                            break
-                        img_bytes = await asyncio.to_thread(client.download_image, img_url)
-
-                        captcha_answer = await asyncio.to_thread(solve_captcha_via_2captcha, img_bytes) if USE_2CAPTCHA else None
-                        if not captcha_answer and USE_2CAPTCHA:
-                            last_msg = "2Captcha không trả lời."
-                            continue
-
-                        if USE_2CAPTCHA and captcha_answer:
-                            result = await asyncio.to_thread(
-                                client.submit_registration,
-                                build_payload(id_ngay, sid, row, captcha_answer)
-                            )
-                            if "!!!True|~~|" in result:
-                                # Parse MaThamDu + HTML xác nhận
-                                arr = result.split("|~~|")
-                                ma = arr[3].strip() if len(arr) > 3 else ""
-                                # Gen QR
-                                qr_url = await asyncio.to_thread(client.gen_qr_image, ma, ma)
-                                qr_abs = ""
-                                qr_bytes = None
-                                if qr_url:
-                                    qr_abs = qr_url if qr_url.startswith("http") else f"{client.root_base_url.rstrip('/')}{qr_url}"
-                                    try:
-                                        qr_bytes = await asyncio.to_thread(client.download_image, qr_abs)
-                                    except Exception:
-                                        qr_bytes = None
-                                # Gửi về Telegram
-                                cap = (
-                                    f"✅ [{day}] Dòng {row['__row_idx'] + 1}\n"
-                                    f"Mã tham dự: `{ma}`\nPhiên: {slabel} ({sid})"
-                                )
-                                if qr_bytes:
-                                    await update.message.reply_photo(photo=qr_bytes, caption=cap, parse_mode="Markdown")
-                                else:
-                                    await update.message.reply_text(cap)
-                                # SendEmail (best-effort)
-                                try:
-                                    _ = await asyncio.to_thread(client.send_email, sid, ma)
-                                except Exception:
-                                    pass
-                                success = True
-                                await add_report(
-                                    Day=day, DayId=id_ngay, SessionValue=sid, SessionLabel=slabel,
-                                    Row=row["__row_idx"] + 1, FullName=row["FullName"],
-                                    DOB_Day=row["DOB_Day"], DOB_Month=row["DOB_Month"], DOB_Year=row["DOB_Year"],
-                                    Phone=row["Phone"], Email=row["Email"], IDNumber=row["IDNumber"],
-                                    Status="Success", Attempts=attempt, Message="OK",
-                                    MaThamDu=ma, QrUrl=qr_abs, Timestamp=datetime.now().isoformat(timespec="seconds"),
-                                )
+                        if day_closed.is_set() or row_idx not in pending:
+                            return  # đã được ghi Skipped khi phiên hết lượt
+                        pending.discard(row_idx)
+                        attempt = 0
+                        outcome, msg = Outcome.CAPTCHA_FAIL, ""
+                        while attempt < CAPTCHA_MAX_TRIES and not day_closed.is_set():
+                            attempt += 1
+                            outcome, msg = await run_attempt(lane, row_idx, attempt)
+                            if outcome is not Outcome.CAPTCHA_FAIL:
                                 break
-                            elif is_session_full(result):
-                                await update.message.reply_text(
-                                    f"⛔ [{day}] Phiên đã hết lượt. Kết thúc xử lý ngày này."
-                                )
-                                # mark current row as skipped-full
-                                await add_report(
-                                    Day=day, DayId=id_ngay, SessionValue=sid, SessionLabel=slabel,
-                                    Row=row["__row_idx"] + 1, FullName=row["FullName"],
-                                    DOB_Day=row["DOB_Day"], DOB_Month=row["DOB_Month"], DOB_Year=row["DOB_Year"],
-                                    Phone=row["Phone"], Email=row["Email"], IDNumber=row["IDNumber"],
-                                    Status="Skipped", Attempts=attempt, Message="Session full",
-                                    MaThamDu="", QrUrl="", Timestamp=datetime.now().isoformat(timespec="seconds"),
-                                )
-                                # mark remaining rows as skipped-full
-                                for row2 in tasks[idx_row + 1:]:
-                                    await add_report(
-                                        Day=day, DayId=id_ngay, SessionValue=sid, SessionLabel=slabel,
-                                        Row=row2["__row_idx"] + 1, FullName=row2["FullName"],
-                                        DOB_Day=row2["DOB_Day"], DOB_Month=row2["DOB_Month"], DOB_Year=row2["DOB_Year"],
-                                        Phone=row2["Phone"], Email=row2["Email"], IDNumber=row2["IDNumber"],
-                                        Status="Skipped", Attempts=0, Message="Session full",
-                                        MaThamDu="", QrUrl="", Timestamp=datetime.now().isoformat(timespec="seconds"),
-                                    )
-                                return  # stop processing remaining rows for this day
-                            elif "captcha" in result.lower():
-                                last_msg = f"Sai captcha (thử {attempt}/{CAPTCHA_MAX_TRIES})."
-                                continue
-                            else:
-                                last_msg = f"Không thành công: {result[:200]}"
-                                break
-                        else:
-                            # manual mode
-                            key = f"{update.effective_chat.id}:{day}:{row['__row_idx']}"
-                            with PENDING_LOCK:
-                                PENDING_CAPTCHAS[key] = {
-                                    "client": client,
-                                    "id_ngay": id_ngay,
-                                    "id_phien": sid,
-                                    "row": row,
-                                    "meta": {
-                                        "Day": day, "DayId": id_ngay, "SessionValue": sid, "SessionLabel": slabel
-                                    },
-                                    "report_list": report_rows,
-                                    "report_lock": report_lock,
-                                }
-                            await update.message.reply_photo(
-                                photo=img_bytes,
-                                caption=f"[{day}] Dòng {row['__row_idx'] + 1}: Vui lòng trả lời tin nhắn này bằng **mã captcha**.",
-                                parse_mode="MarkdownV2",
-                            )
-                            last_msg = "Chuyển sang nhập tay."
-                            break
-                    except Exception as e:
-                        last_msg = f"Lỗi attempt {attempt}: {e}"
-                        continue
-
-                if not success and USE_2CAPTCHA:
-                    await update.message.reply_text(
-                        f"⏭️ [{day}] Dòng {row['__row_idx'] + 1} — Bỏ qua sau {CAPTCHA_MAX_TRIES} lần thử. {last_msg}"
-                    )
-                    await add_report(
-                        Day=day, DayId=id_ngay, SessionValue=sid, SessionLabel=slabel,
-                        Row=row["__row_idx"] + 1, FullName=row["FullName"],
-                        DOB_Day=row["DOB_Day"], DOB_Month=row["DOB_Month"], DOB_Year=row["DOB_Year"],
-                        Phone=row["Phone"], Email=row["Email"], IDNumber=row["IDNumber"],
-                        Status="Failed", Attempts=attempt, Message=last_msg or "Max attempts",
-                        MaThamDu="", QrUrl="", Timestamp=datetime.now().isoformat(timespec="seconds"),
-                    )
+                    finally:
+                        lanes.put_nowait(lane)
+
+                    if outcome in (Outcome.SUCCESS, Outcome.MANUAL):
+                        if outcome is Outcome.MANUAL:
+                            await status.add(f"✍️ Dòng {row_idx + 1} — chờ nhập captcha tay")
+                        return
+                    if outcome is Outcome.SESSION_FULL and not day_closed.is_set():
+                        day_closed.set()
+                        skipped = sorted(pending)
+                        pending.clear()
+                        await status.add("⛔ Phiên đã hết lượt. Kết thúc xử lý ngày này.",
+                                         rows=len(skipped) + 1, force=True)
+                        # dòng hiện tại + các dòng chưa bắt đầu: skipped-full
+                        await add_row_report(day, id_ngay, session, row_idx, "Skipped", attempt, "Session full")
+                        for idx2 in skipped:
+                            await add_row_report(day, id_ngay, session, idx2, "Skipped", 0, "Session full")
+                        return
+                    if day_closed.is_set() and outcome in (Outcome.SESSION_FULL, Outcome.CAPTCHA_FAIL):
+                        # dòng đang chạy dở khi dòng khác báo hết lượt
+                        await status.add(f"⛔ Dòng {row_idx + 1} — phiên đã hết lượt")
+                        await add_row_report(day, id_ngay, session, row_idx, "Skipped", attempt, "Session full")
+                        return
+                    await status.add(f"⏭️ Dòng {row_idx + 1} — Bỏ qua sau {attempt} lần thử. {msg}")
+                    await add_row_report(day, id_ngay, session, row_idx, "Failed", attempt, msg or "Max attempts")
 
-        except Exception as e:
-            await update.message.reply_text(f"[{day}] Lỗi: {e}")
-        finally:
-            with ACTIVE_LOCK:
+                try:
+                    async with asyncio.TaskGroup() as tg:
+                        for row_idx in tasks:
+                            tg.create_task(do_row(row_idx))
+                finally:
+                    for lane in lane_list:
+                        if lane is not client:
+                            await lane.aclose()
+
+            except Exception as e:
+                log.exception(f"[{day}] process_day failed")
+                # lỗi bên trong TaskGroup tới dạng ExceptionGroup => báo lỗi thật cho người dùng
+                while isinstance(e, ExceptionGroup) and e.exceptions:
+                    e = e.exceptions[0]
+                await update.message.reply_text(f"[{day}] Lỗi: {e}")
+            finally:
+                await status.close()
+                await status.flush_photos()
                 ACTIVE_DAYS.discard(day)
                 # Chỉ đánh dấu COMPLETED khi BẬT dedup toàn cục
                 if not DISABLE_GLOBAL_DAY_DEDUP:
-                    COMPLETED_DAYS.add(day)
-
-    # tạo task asyncio cho mỗi ngày và đợi hoàn tất để xuất báo cáo
-    tasks = [context.application.create_task(process_day(d, buckets[d])) for d in days_to_run]
-    await update.message.reply_text("Đã khởi chạy các task theo ngày. Bot sẽ báo kết quả khi có.")
-
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    COMPLETED_DAYS[day] = True
+
+        # chạy các ngày đồng thời (tối đa MAX_WORKERS ngày cùng lúc) và đợi hoàn tất để xuất báo cáo
+        day_sem = asyncio.Semaphore(MAX_WORKERS_CAP)
+
+        # mỗi ngày xử lý toàn bộ các dòng hợp lệ (theo index, không copy dict); dòng lỗi ghi Failed cho từng ngày
+        row_ids = [i for i in range(len(rows)) if i not in bad_rows]
+        for day in days_to_run:
+            for i, c in sorted(bad_rows.items()):
+                await add_row_report(day, day_to_id.get(day, ""), {}, i, "Failed", 0, f"Giá trị không hợp lệ ở cột {c}")
+
+        async def run_day(day: str):
+            async with day_sem:
+                await process_day(day, day_to_id.get(day), row_ids)
+
+        await update.message.reply_text("Đã khởi chạy các task theo ngày. Bot sẽ báo kết quả khi có.")
+        await asyncio.gather(*(run_day(d) for d in days_to_run), return_exceptions=True)
+    finally:
+        # reply_text/khởi tạo lỗi trước khi process_day chạy => không để ngày kẹt trong ACTIVE_DAYS
+        ACTIVE_DAYS.difference_update(days_to_run)
     # Tổng hợp & xuất báo cáo
     if not report_rows:
         await update.message.reply_text("Không có dữ liệu báo cáo (có thể tất cả bị chặn trước khi chạy).")
@@ -559,79 +1107,67 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat_id = update.effective_chat.id
     text = update.message.text.strip()
-    key = None
-    with PENDING_LOCK:
-        for k in list(PENDING_CAPTCHAS.keys()):
-            if k.startswith(f"{chat_id}:"):
-                key = k
-                break
-    if not key:
+    queue = PENDING_CAPTCHAS.get(chat_id)
+    if not queue:
         return
+    key, data = queue.popleft()
+    if not queue:
+        del PENDING_CAPTCHAS[chat_id]
+    log.info(f"[CAPTCHA] manual answer for {key}")
 
-    data = None
-    with PENDING_LOCK:
-        data = PENDING_CAPTCHAS.pop(key, None)
-    if not data:
-        await update.message.reply_text("Không tìm thấy tác vụ captcha tương ứng.")
-        return
-
-    client: PopmartClient = data["client"]
+    client: PopmartClient = context.application.bot_data["client"]
     id_ngay = data["id_ngay"]
     id_phien = data["id_phien"]
     row = data["row"]
+    row_idx: int = data["row_idx"]
     meta = data.get("meta", {})
     report_list = data.get("report_list")
     report_lock: asyncio.Lock = data.get("report_lock")  # type: ignore
 
     try:
-        result = await asyncio.to_thread(
-            client.submit_registration,
-            build_payload(id_ngay, id_phien, row, text)
+        result = await client.submit_registration(
+            build_payload(id_ngay, id_phien, data["base"], text)
         )
-        if "!!!True|~~|" in result:
-            arr = result.split("|~~|")
-            ma = arr[3].strip() if len(arr) > 3 else ""
-            qr_url = await asyncio.to_thread(client.gen_qr_image, ma, ma)
-            qr_abs = qr_url if (qr_url and qr_url.startswith("http")) else (f"{client.root_base_url.rstrip('/')}{qr_url}" if qr_url else "")
-            qr_bytes = None
-            if qr_abs:
+        kind = classify_response(result)
+        if kind is Outcome.SUCCESS:
+            ma = _ma_tham_du(result)
+
+            async def on_qr(qr_abs: str, qr_bytes: Optional[bytes]):
+                # Ghi báo cáo trước: lỗi gửi Telegram ở dưới không làm mất dòng Success
+                if report_list is not None and report_lock is not None:
+                    async with report_lock:
+                        report_list.append({
+                            "Day": meta.get("Day", ""),
+                            "DayId": meta.get("DayId", ""),
+                            "SessionValue": meta.get("SessionValue", ""),
+                            "SessionLabel": meta.get("SessionLabel", ""),
+                            "Row": row_idx + 1,
+                            "FullName": row["FullName"],
+                            "DOB_Day": row["DOB_Day"],
+                            "DOB_Month": row["DOB_Month"],
+                            "DOB_Year": row["DOB_Year"],
+                            "Phone": row["Phone"],
+                            "Email": row["Email"],
+                            "IDNumber": row["IDNumber"],
+                            "Status": "Success",
+                            "Attempts": 1,
+                            "Message": "OK (manual captcha)",
+                            "MaThamDu": ma,
+                            "QrUrl": qr_abs,
+                            "Timestamp": datetime.now().isoformat(timespec="seconds"),
+                        })
+                cap = f"✅ Thành công.\nMã tham dự: `{ma}`"
+                if not qr_bytes:
+                    await update.message.reply_text(cap)
+                    return
                 try:
-                    qr_bytes = await asyncio.to_thread(client.download_image, qr_abs)
-                except Exception:
-                    qr_bytes = None
-            cap = f"✅ Thành công.\nMã tham dự: `{ma}`"
-            if qr_bytes:
-                await update.message.reply_photo(photo=qr_bytes, caption=cap, parse_mode="Markdown")
-            else:
-                await update.message.reply_text(cap)
-            try:
-                _ = await asyncio.to_thread(client.send_email, id_phien, ma)
-            except Exception:
-                pass
+                    await update.message.reply_photo(photo=qr_bytes, caption=cap, parse_mode="Markdown")
+                except BadRequest:
+                    # mã do site trả về có thể phá Markdown: gửi lại caption thường
+                    await update.message.reply_photo(photo=qr_bytes, caption=cap)
 
-            if report_list is not None and report_lock is not None:
-                async with report_lock:
-                    report_list.append({
-                        "Day": meta.get("Day", ""),
-                        "DayId": meta.get("DayId", ""),
-                        "SessionValue": meta.get("SessionValue", ""),
-                        "SessionLabel": meta.get("SessionLabel", ""),
-                        "Row": row["__row_idx"] + 1,
-                        "FullName": row["FullName"],
-                        "DOB_Day": row["DOB_Day"],
-                        "DOB_Month": row["DOB_Month"],
-                        "DOB_Year": row["DOB_Year"],
-                        "Phone": row["Phone"],
-                        "Email": row["Email"],
-                        "IDNumber": row["IDNumber"],
-                        "Status": "Success",
-                        "Attempts": 1,
-                        "Message": "OK (manual captcha)",
-                        "MaThamDu": ma,
-                        "QrUrl": qr_abs,
-                        "Timestamp": datetime.now().isoformat(timespec="seconds"),
-                    })
-        elif is_session_full(result):
+            await after_success(client, id_phien, ma, f"manual {key}", on_qr)
+        elif kind is Outcome.SESSION_FULL:
             await update.message.reply_text("⛔ Phiên đã hết lượt.")
             if report_list is not None and report_lock is not None:
                 async with report_lock:
@@ -640,7 +1176,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "DayId": meta.get("DayId", ""),
                         "SessionValue": meta.get("SessionValue", ""),
                         "SessionLabel": meta.get("SessionLabel", ""),
-                        "Row": row["__row_idx"] + 1,
+                        "Row": row_idx + 1,
                         "FullName": row["FullName"],
                         "DOB_Day": row["DOB_Day"],
                         "DOB_Month": row["DOB_Month"],
@@ -655,7 +1191,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "QrUrl": "",
                         "Timestamp": datetime.now().isoformat(timespec="seconds"),
                     })
-        elif "captcha" in result.lower():
+        elif kind is Outcome.CAPTCHA_FAIL:
             await update.message.reply_text("❌ Sai captcha. Gửi lại mã hoặc /start để gửi file mới.")
             if report_list is not None and report_lock is not None:
                 async with report_lock:
@@ -664,7 +1200,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "DayId": meta.get("DayId", ""),
                         "SessionValue": meta.get("SessionValue", ""),
                         "SessionLabel": meta.get("SessionLabel", ""),
-                        "Row": row["__row_idx"] + 1,
+                        "Row": row_idx + 1,
                         "FullName": row["FullName"],
                         "DOB_Day": row["DOB_Day"],
                         "DOB_Month": row["DOB_Month"],
@@ -680,7 +1216,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "Timestamp": datetime.now().isoformat(timespec="seconds"),
                     })
         else:
-            await update.message.reply_text(f"⚠️ Không thành công: {result[:200]}")
+            await update.message.reply_text(f"⚠️ Không thành công: {_preview(result)}")
             if report_list is not None and report_lock is not None:
                 async with report_lock:
                     report_list.append({
@@ -688,7 +1224,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "DayId": meta.get("DayId", ""),
                         "SessionValue": meta.get("SessionValue", ""),
                         "SessionLabel": meta.get("SessionLabel", ""),
-                        "Row": row["__row_idx"] + 1,
+                        "Row": row_idx + 1,
                         "FullName": row["FullName"],
                         "DOB_Day": row["DOB_Day"],
                         "DOB_Month": row["DOB_Month"],
@@ -698,7 +1234,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "IDNumber": row["IDNumber"],
                         "Status": "Failed",
                         "Attempts": 1,
-                        "Message": (result or "")[:200],
+                        "Message": _preview(result),
                         "MaThamDu": "",
                         "QrUrl": "",
                         "Timestamp": datetime.now().isoformat(timespec="seconds"),
@@ -716,10 +1252,45 @@ async def on_error(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
 
 
+async def on_startup(app):
+    # PopmartClient (và pool kết nối) dùng chung cho toàn bộ bot
+    client = PopmartClient(BASE_URL, POP_PAGE_PATH, AJAX_PATH, REQUEST_TIMEOUT)
+    app.bot_data["client"] = client
+    # làm nóng pool kết nối trước khi có file đầu tiên (không chặn khởi động)
+    app.bot_data["prewarm_task"] = asyncio.create_task(client.prewarm())
+
+    if USE_2CAPTCHA and PINGBACK_URL:
+        webapp = web.Application()
+        webapp.router.add_route("*", "/2captcha", handle_2captcha_pingback)
+        runner = web.AppRunner(webapp)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", PINGBACK_PORT).start()
+        app.bot_data["pingback_runner"] = runner
+        log.info(f"[2CAPTCHA] pingback server on :{PINGBACK_PORT} -> {PINGBACK_URL} (token bắt buộc)")
+
+
+async def on_shutdown(app):
+    client: Optional[PopmartClient] = app.bot_data.pop("client", None)
+    if client:
+        await client.aclose()
+    if _captcha_poller is not None:
+        _captcha_poller.cancel()
+    await _2captcha_client.aclose()
+    runner: Optional[web.AppRunner] = app.bot_data.pop("pingback_runner", None)
+    if runner:
+        await runner.cleanup()
+
+
 def main():
     if not BOT_TOKEN:
         raise SystemExit("Missing TELEGRAM_BOT_TOKEN")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_excel))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))